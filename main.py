@@ -1,10 +1,13 @@
 import os
 import re
+import json
+import codecs
+from functools import lru_cache
+from io import IncrementalNewlineDecoder
 from sys import argv
 from dataclasses import dataclass
 from configparser import ConfigParser
 
-import yaml
 from PyQt6.QtWidgets import (
     QPlainTextEdit,
     QApplication, 
@@ -31,50 +34,100 @@ from PyQt6.QtGui import (
     QTextCharFormat,
     QTextDocument,
     QKeySequence,
+    QTextCursor,
     QKeyEvent,
     QColor,
     QFont,
 )
 
 from PyQt6.QtCore import (
+    QThreadPool,
     QModelIndex,
+    QRunnable,
+    QObject,
     QDir,
     Qt,
+    pyqtSignal,
     pyqtSlot,
 )
 
+@lru_cache(maxsize=None)
+def loadYaml(path: str, mtime: float):
+    # mtime is part of the cache key so an edited file is parsed again
+    cachePath = path + ".json"
+    if os.path.exists(cachePath) and os.path.getmtime(cachePath) >= mtime:
+        try:
+            with open(cachePath, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            pass # a half written cache is rebuilt from the yaml below
+
+    # PyYAML is only needed when a file has no up to date json copy
+    import yaml
+    yamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+    with open(path, 'r') as f:
+        data = yaml.load(f, Loader=yamlLoader)
+
+    # the json copy is optional, so a failed dump (e.g. a date value) is dropped. files need plain string keys
+    tempPath = cachePath + ".tmp"
+    try:
+        with open(tempPath, 'w') as f:
+            json.dump(data, f)
+        os.replace(tempPath, cachePath)
+    except (OSError, TypeError, ValueError):
+        try:
+            os.remove(tempPath)
+        except OSError:
+            pass
+
+    return data
+
+def buildJsonCaches():
+    # writes the json copy of every theme and syntax file up front, e.g. as an install step
+    for directory, extension in ((HarmonyPaths.Themes, ".theme"), (HarmonyPaths.Languages, ".lang")):
+        for fn in os.listdir(directory):
+            if fn.endswith(extension):
+                path = os.path.join(directory, fn)
+                loadYaml(path, os.path.getmtime(path))
+
 def loadSettings():
     configParser = ConfigParser()
-    configParser.read(os.path.abspath("settings.ini"))
+    configParser.read(HarmonyPaths.Settings)
     return configParser
 
 def loadTheme(configParser: ConfigParser):
     themeName = configParser.get('settings', 'theme')
-    themePath = os.path.join(os.path.abspath('themes'), "%s.theme" % themeName)
+    themePath = os.path.join(HarmonyPaths.Themes, "%s.theme" % themeName)
 
     try:
-        with open(themePath, 'r') as f:
-            return yaml.safe_load(f)
+        theme = loadYaml(themePath, os.path.getmtime(themePath))
     except FileNotFoundError:
         QMessageBox(QMessageBox.Icon.Warning, "Warning", "Could not open theme. %s" % themeName).exec()
+        return
+
+    # colours are parsed once here, on copies so the dict cached by loadYaml is left as it was parsed
+    syntax = {ruleType: dict(rule, qcolour=QColor(rule['colour'])) if 'colour' in rule else rule for ruleType, rule in theme.get('syntax', {}).items()}
+    return dict(theme, syntax=syntax)
 
 def loadSyntax(lang: str):
-    langPath = os.path.join(os.path.abspath('languages'), "%s.lang" % lang)
+    langPath = os.path.join(HarmonyPaths.Languages, "%s.lang" % lang)
 
     try:
-        with open(langPath, 'r') as f:
-            return yaml.safe_load(f)
+        return loadYaml(langPath, os.path.getmtime(langPath))
     except FileNotFoundError:
         QMessageBox(QMessageBox.Icon.Warning, "Warning", "Could not open syntax file. %s" % langPath).exec()
         return {}
 
 def getThemes():
-    fileNames = os.listdir(os.path.abspath("themes"))
+    fileNames = os.listdir(HarmonyPaths.Themes)
 
     themes = []
     for fn in fileNames:
-        with open(os.path.join(os.path.abspath("themes"), fn), 'r') as f:
-            ymlData = yaml.safe_load(f)
+        if not fn.endswith(".theme"):
+            continue
+        themePath = os.path.join(HarmonyPaths.Themes, fn)
+        ymlData = loadYaml(themePath, os.path.getmtime(themePath))
         
         themes.append(Theme(fn, ymlData['display']))
     
@@ -94,6 +147,20 @@ class SettingsWindowSettings:
     Height = 720
     Title = "Settings"
 
+class HarmonyPaths:
+    # resolved once at import, these are relative to the directory Harmony is launched from
+    Settings = os.path.abspath("settings.ini")
+    Themes = os.path.abspath("themes")
+    Languages = os.path.abspath("languages")
+
+class HighlighterSettings:
+    # google-re2 is linear time but several times slower than re on ordinary lines
+    UseRe2 = False
+
+class FileSettings:
+    BufferSize = 1024 * 1024
+    Encoding = 'utf-8'
+
 @dataclass
 class Theme:
     FileName: str
@@ -159,25 +226,57 @@ class Settings(QDialog):
         # TODO save settings
         ...
 
+class TokenizerSignals(QObject):
+    # QRunnable isn't a QObject, so the tokenizer reports back through this
+    finished = pyqtSignal(int, list)
+
+class TokenizerRunnable(QRunnable):
+    def __init__(self, generation: int, lines: list[str], findSpans):
+        QRunnable.__init__(self)
+        self.generation = generation
+        self.lines = lines
+        self.findSpans = findSpans
+        self.signals = TokenizerSignals()
+
+    def run(self):
+        results = [(line, self.findSpans(line, BlockState.OutsideComment)) for line in self.lines if line]
+        self.signals.finished.emit(self.generation, results)
+
 class SyntaxHighlighter(QSyntaxHighlighter):
+    RuleTypes = ('keyword', 'operator', 'brace', 'definition', 'string', 'comment', 'special')
+    ChunkSize = 500
+
     def __init__(self, document: QTextDocument, theme: dict, language: str):
         QSyntaxHighlighter.__init__(self, document)
         self.theme = theme['syntax']
-        self.language = loadSyntax(language)
+        self.languageName = language
+        self.language = None
+        self.rules = None
+        self.groupNumbers = None
+
+        self.formats = {ruleType: self.getFormat(ruleType) for ruleType in self.RuleTypes}
+
+        # unchanged lines are re-highlighted constantly, so their spans are remembered per highlighter
+        self.cachedSpans = lru_cache(maxsize=4096)(self.findSpans)
+
+        self.pretokenized: dict[str, tuple] = {}
+        self.pendingChunks = 0
+        self.pendingDocument = None
+        self.generation = 0
     
-    def isInsideComment(self):
-        return self.previousBlockState() == BlockState.InsideComment
+    def isInsideComment(self, blockState: int):
+        return blockState == BlockState.InsideComment
     
-    def isOutsideComment(self):
-        return self.previousBlockState() == BlockState.OutsideComment
+    def isOutsideComment(self, blockState: int):
+        return blockState == BlockState.OutsideComment
 
     def getFormat(self, ruleType: str):
-        if ruleType not in ('keyword', 'operator', 'brace', 'definition', 'string', 'comment', 'special'):
+        if ruleType not in self.RuleTypes:
             raise ValueError("Invalid formatting type")
         
         fmt = QTextCharFormat()
         try:
-            fmt.setForeground(QColor(self.theme[ruleType]['colour']))
+            fmt.setForeground(self.theme[ruleType]['qcolour'])
             fmt.setFontItalic(self.theme[ruleType]['italic'])
         except KeyError as error:
             QMessageBox(QMessageBox.Icon.Critical, "Error", "Invalid format").exec()
@@ -185,45 +284,126 @@ class SyntaxHighlighter(QSyntaxHighlighter):
 
         return fmt
 
-    def highlightBlock(self, text: str):
-        keywordFormat = self.getFormat('keyword')
-        operatorFormat = self.getFormat('operator')
-        braceFormat = self.getFormat('brace')
-        specialFormat = self.getFormat('special')
-        definitionFormat = self.getFormat('definition')
-        stringFormat = self.getFormat('string')
-        commentFormat = self.getFormat('comment')
+    def compileRules(self):
+        # one named group per rule type, the first matching group and rule wins so .lang files list longer forms first
+        self.rules = None
 
         try:
-            keywordRules = [r'\b%s\b' % kw for kw in self.language['keywords']]
-            operatorRules = [r'%s' % o for o in self.language['operators']]
-            braceRules = [r'%s' % b for b in self.language['braces']]
-            definitionRules = [r'\b%s\b\s*(\w+)' % d for d in self.language['definitions']]
-            stringRules = [
-                r'"[^"\\]*(\\.[^"\\]*)*"',
-                r"'[^'\\]*(\\.[^'\\]*)*'"
-            ] # strings tend to be the same regardless of language and they are icky to deal with in yml
-            specialRules = [r'%s' % s for s in self.language['specials']]
-            commentRule = r'%s[^\n]*' % self.language['comment']
-
-            self.searchAndApplyFormatting(text, keywordRules, keywordFormat)
-            self.searchAndApplyFormatting(text, operatorRules, operatorFormat)
-            self.searchAndApplyFormatting(text, braceRules, braceFormat)
-            self.searchAndApplyFormatting(text, specialRules, specialFormat)
-            self.searchAndApplyFormatting(text, definitionRules, definitionFormat, 1)
-            self.searchAndApplyFormatting(text, stringRules, stringFormat)
-
-            for match in re.finditer(commentRule, text):
-                self.setFormat(match.start(), match.end() - match.start(), commentFormat)
-
+            definitionRule = r'(?P<definitionKeyword>\b(?:%s)\b)\s*(?P<definitionName>\w+)' % '|'.join(self.language['definitions'])
+            groups = [
+                ('comment', r'%s[^\n]*' % self.language['comment']),
+                ('string', r'"[^"\\]*(?:\\.[^"\\]*)*"|' r"'[^'\\]*(?:\\.[^'\\]*)*'"), # strings tend to be the same regardless of language and they are icky to deal with in yml
+                ('definition', definitionRule if self.language['definitions'] else ''),
+                ('keyword', r'\b(?:%s)\b' % '|'.join(self.language['keywords']) if self.language['keywords'] else ''),
+                ('special', '|'.join(self.language['specials'])),
+                ('operator', '|'.join(self.language['operators'])),
+                ('brace', '|'.join(self.language['braces'])),
+            ]
         except KeyError:
             QMessageBox(QMessageBox.Icon.Critical, "Error", "Invalid format").exec()
             return
+
+        rules = '|'.join('(?P<%s>%s)' % (ruleType, rule) for ruleType, rule in groups if rule)
+        if not rules:
+            return
+
+        # re2's match objects only take group numbers, None means names can be passed straight to re
+        self.groupNumbers = None
+        if HighlighterSettings.UseRe2:
+            try:
+                import re2
+                self.rules = re2.compile(rules)
+                self.groupNumbers = self.rules.groupindex
+                return
+            except ImportError:
+                pass
+            except re2.error:
+                pass # re2 has no lookarounds or backreferences, syntax files that use them fall back to re
+
+        self.rules = re.compile(rules)
+
+    def highlightBlock(self, text: str):
+        # read once, every previousBlockState call goes through to Qt
+        blockState = self.previousBlockState()
+        if not text:
+            self.setCurrentBlockState(blockState)
+            return
+
+        self.loadRules()
+        if self.rules is None:
+            return
+
+        spans = self.pretokenized.get(text)
+        if spans is None:
+            spans = self.cachedSpans(text, blockState)
+
+        for start, length, ruleType in spans:
+            self.setFormat(start, length, self.formats[ruleType])
+
+    def loadRules(self):
+        # loaded on first use rather than on construction, Tab.loadFile still triggers it on the main thread
+        if self.language is None:
+            # files without an extension, or whose syntax file is missing, are left as plain text
+            self.language = loadSyntax(self.languageName) if self.languageName else {}
+            if self.language:
+                self.compileRules()
+
+    def highlightInBackground(self, document: QTextDocument):
+        # the highlighter stays detached until every chunk is tokenized, then attachDocument does one pass
+        self.loadRules()
+        lines = document.toPlainText().split('\n') if self.rules is not None else []
+
+        # a newer load makes any chunks still running for an older one stale
+        self.generation += 1
+        self.pendingDocument = document
+        self.pendingChunks = 0
+        self.pretokenized.clear()
+
+        # not worth a round trip through the pool, highlighted straight away
+        if len(lines) <= self.ChunkSize:
+            self.attachDocument()
+            return
+
+        for firstLine in range(0, len(lines), self.ChunkSize):
+            runnable = TokenizerRunnable(self.generation, lines[firstLine:firstLine + self.ChunkSize], self.findSpans)
+            runnable.signals.finished.connect(self.applyChunk)
+            self.pendingChunks += 1
+            QThreadPool.globalInstance().start(runnable)
+
+    @pyqtSlot(int, list)
+    def applyChunk(self, generation: int, results: list):
+        if generation != self.generation:
+            return
+
+        self.pretokenized.update(results)
+        self.pendingChunks -= 1
+        if not self.pendingChunks:
+            self.attachDocument()
+
+    def attachDocument(self):
+        # setDocument only queues a rehighlight, running it here replays the pretokenized spans in one pass
+        self.setDocument(self.pendingDocument)
+        self.rehighlight()
+        self.pendingDocument = None
+        self.pretokenized.clear()
+
+    def findSpans(self, text: str, blockState: int):
+        # blockState is only used as part of the cache key, no rule spans multiple blocks yet
+        spans = []
+        for match in self.rules.finditer(text):
+            if match.lastgroup == 'definition':
+                self.addSpan(spans, match, 'definitionKeyword', 'keyword')
+                self.addSpan(spans, match, 'definitionName', 'definition')
+            else:
+                self.addSpan(spans, match, match.lastgroup, match.lastgroup)
+        return tuple(spans)
     
-    def searchAndApplyFormatting(self, text: str, rules: list[str], format: QTextCharFormat, index: int = 0):
-        for rule in rules:
-            for match in re.finditer(rule, text):
-                self.setFormat(match.start(index), match.end(index) - match.start(index), format)
+    def addSpan(self, spans: list[tuple[int, int, str]], match: re.Match, group: str, ruleType: str):
+        start, end = match.span(group if self.groupNumbers is None else self.groupNumbers[group])
+        # touching matches of the same type (e.g. '))' or '==') are merged into a single setFormat call
+        if spans and spans[-1][2] == ruleType and spans[-1][0] + spans[-1][1] == start:
+            start = spans.pop()[0]
+        spans.append((start, end - start, ruleType))
 
 class TextBox(QPlainTextEdit):
     def __init__(self, theme: dict, language: str):
@@ -254,7 +434,8 @@ class Tab(QWidget):
         QWidget.__init__(self)
         self.theme = theme
         self.filePath = filePath
-        language = self.filePath.split('.')[1]
+        self.loadFailed = False
+        language = os.path.splitext(self.filePath)[1].lstrip('.').lower()
         self.body = TextBox(theme, language)
 
         self.build()
@@ -265,16 +446,45 @@ class Tab(QWidget):
         self.layout().addWidget(self.body)
     
     def loadFile(self):
+        # streamed in chunks inside one edit block rather than handed to setPlainText as a single string
+        document = self.body.document()
+        decoder = IncrementalNewlineDecoder(codecs.getincrementaldecoder(FileSettings.Encoding)(), translate=True)
+
+        # detached so inserting the text doesn't highlight it as it goes, highlightInBackground reattaches it
+        self.body.syntaxHighlighter.setDocument(None)
+        document.setUndoRedoEnabled(False)
+        # replaces what the document already holds, like setPlainText did, so reloading can't duplicate the text
+        document.clear()
+        cursor = QTextCursor(document)
+        cursor.beginEditBlock()
         try:
-            with open(self.filePath, 'r') as file:
-                self.body.setPlainText(file.read())
-        except OSError:
+            with open(self.filePath, 'rb', buffering=FileSettings.BufferSize) as file:
+                while chunk := file.read(FileSettings.BufferSize):
+                    cursor.insertText(decoder.decode(chunk))
+            cursor.insertText(decoder.decode(b'', final=True))
+            self.loadFailed = False
+        except (OSError, UnicodeDecodeError):
+            self.loadFailed = True
             QMessageBox(QMessageBox.Icon.Critical, "Error", "Cannot open file. %s" % self.filePath).exec()
+        finally:
+            cursor.endEditBlock()
+            document.setUndoRedoEnabled(True)
+
+        if self.loadFailed:
+            document.clear()
+
+        self.body.syntaxHighlighter.highlightInBackground(document)
+        self.body.moveCursor(QTextCursor.MoveOperation.Start)
 
     def saveFile(self):
+        # the tab doesn't hold the file's real contents, writing it back would overwrite the file
+        if self.loadFailed:
+            return
+
         try:
-            with open(self.filePath, 'w') as file:
-                file.write(self.body.toPlainText())
+            data = self.body.toPlainText().replace('\n', os.linesep).encode(FileSettings.Encoding)
+            with open(self.filePath, 'wb', buffering=FileSettings.BufferSize) as file:
+                file.write(data)
         except OSError:
             QMessageBox(QMessageBox.Icon.Critical, "Error", "Cannot save file. %s" % self.filePath).exec()
 
@@ -283,20 +493,19 @@ class TabContainer(QTabWidget):
         QTabWidget.__init__(self)
         self.theme = theme
         self.settings = settings
-        self.tabs = []
+        self.tabs: dict[str, Tab] = {}
     
     def openOrCreateTab(self, filePath: str):
-        for tab in self.tabs:
-            if tab.filePath == filePath:
-                self.setCurrentIndex(self.indexOf(tab))
-                return
+        tab = self.tabs.get(filePath)
+        if tab is not None:
+            self.setCurrentIndex(self.indexOf(tab))
+            return
         self.createTab(filePath)
     
     def createTab(self, filePath: str):
         tab = Tab(self.theme, filePath)
-        self.addTab(tab, filePath.split('/')[-1])
-        self.tabs.append(tab)
-        tab.loadFile()
+        self.addTab(tab, os.path.basename(filePath))
+        self.tabs[filePath] = tab
         self.setCurrentIndex(self.indexOf(tab))
     
     def saveTab(self):
@@ -304,8 +513,7 @@ class TabContainer(QTabWidget):
     
     def closeTab(self):
         self.saveTab()
-        tab = self.indexOf(self.currentWidget())
-        self.tabs.pop(tab)
+        self.tabs.pop(self.currentWidget().filePath)
         self.removeTab(self.currentIndex())
 
 class FilePopup(QDialog):
@@ -375,7 +583,7 @@ class FileTree(QWidget):
 
     def updateFilePath(self, newFilePath: str):
         self.filePath = newFilePath
-        self.configureTreeView()
+        self.updateTreeRoot()
 
     def configureStyling(self):
         self.setStyleSheet(f"""
@@ -383,15 +591,18 @@ class FileTree(QWidget):
         """)
 
     def configureTreeView(self):
-        self.model.setRootPath(self.filePath)
-        index = self.model.index(self.model.rootPath())
+        # only run once, connecting the signals again would fire treeOnClick multiple times per click
         self.tree.setModel(self.model)
-        self.tree.setRootIndex(index)
         self.tree.clicked.connect(self.treeOnClick)
         self.tree.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
         self.tree.customContextMenuRequested.connect(self.customContextMenu)
         for i in range(1, 4):
             self.tree.hideColumn(i)
+        self.updateTreeRoot()
+
+    def updateTreeRoot(self):
+        self.model.setRootPath(self.filePath)
+        self.tree.setRootIndex(self.model.index(self.model.rootPath()))
     
     @pyqtSlot(QModelIndex)
     def treeOnClick(self, index: QModelIndex):
@@ -503,6 +714,10 @@ class Harmony(QMainWindow):
         self.setFont(QFont(fontName, fontSize))
 
 def main():
+    if "--build-cache" in argv[1:]:
+        buildJsonCaches()
+        return
+
     app = QApplication(argv)
     app.setStyle('Fusion')
     harmony = Harmony()